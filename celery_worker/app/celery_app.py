@@ -1,11 +1,18 @@
+import logging
 import os
 import sys
 from celery import Celery
 from celery.schedules import crontab
+from kombu import Exchange, Queue
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    format="[%(asctime)s: %(levelname)s/%(processName)s] %(name)s: %(message)s",
+)
+
 # Add the task_parser app to the Python path to share models
 sys.path.insert(0, os.path.abspath('/task_parser_app'))
 
@@ -24,8 +31,33 @@ celery_app.conf.beat_schedule = {
     },
 }
 
+celery_app.conf.task_queues = (
+    Queue('celery'),
+    # Network-bound tools, consumed by the gevent worker (see docker-compose.yml).
+    Queue('io'),
+    # The beat's own dispatcher message is fire-and-forget and re-sent every
+    # minute, so it doesn't need to be persisted by the broker.
+    Queue('transient', Exchange('transient', delivery_mode=1), routing_key='transient', durable=False),
+)
+celery_app.conf.task_routes = {
+    'dispatch_periodic_tasks': {'queue': 'transient'},
+    'send_email': {'queue': 'io'},
+    'scrape_web': {'queue': 'io'},
+    'call_api': {'queue': 'io'},
+}
+
 celery_app.conf.update(
     task_track_started=True,
+    # Logging is configured above; keep Celery from replacing the root handlers.
+    worker_hijack_root_logger=False,
     timezone='UTC',
     enable_utc=True,
+    # Nothing reads task results (chained steps receive the previous result in
+    # the message itself), so don't write one to the backend per task.
+    task_ignore_result=True,
+    result_expires=3600,
+    broker_transport_options={'visibility_timeout': 3600, 'socket_keepalive': True},
+    # Connections kept open in the broker pool; sized so a burst of due
+    # workflows from the beat can publish without re-connecting.
+    broker_pool_limit=20,
 )
\ No newline at end of file
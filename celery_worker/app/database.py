@@ -1,18 +1,22 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import orjson
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
-# Use a synchronous DB driver for Celery
-SYNC_DATABASE_URL = os.environ["DATABASE_URL"].replace("+asyncpg", "")
+# The scheduler talks to Postgres over asyncpg's binary protocol.
+DATABASE_URL = os.environ["DATABASE_URL"]
+ASYNC_DATABASE_URL = "postgresql+asyncpg://" + DATABASE_URL.split("://", 1)[1]
 
-engine = create_engine(SYNC_DATABASE_URL)
-SessionLocal = sessionmaker(
-    autocommit=False, autoflush=False, bind=engine, expire_on_commit=False
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,  # Drop connections the server closed while idle between ticks
+    pool_recycle=1800,
+    isolation_level="READ COMMITTED",
+    # Every tick decodes the due tasks' workflow JSON; orjson is much faster than stdlib json.
+    json_serializer=lambda value: orjson.dumps(value).decode(),
+    json_deserializer=orjson.loads,
+)
+AsyncSessionLocal = async_sessionmaker(
+    bind=engine, autoflush=False, expire_on_commit=False
 )
-
-def get_db_session():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
\ No newline at end of file
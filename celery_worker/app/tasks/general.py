@@ -1,44 +1,163 @@
 import time
 from celery_app import celery_app
+from celery.signals import worker_process_shutdown, worker_shutdown
 
+import logging
 import os
+import queue
 import smtplib
 import ssl
 from email.message import EmailMessage
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree, html
 
+log = logging.getLogger(__name__)
 
 # The SMTP server and port for Gmail
 SMTP_HOST = "smtp.gmail.com"
 SMTP_PORT = 587
 
+# Sender credentials are fixed for the life of the worker, so they are read once
+# here; a missing variable stops the worker at startup instead of failing every send.
+_SENDER_EMAIL = os.environ["EMAIL_HOST_USER"]
+_SENDER_PASSWORD = os.environ["EMAIL_HOST_PASSWORD"]
+_SENDER_NAME = os.environ.get("EMAIL_SENDER_NAME", _SENDER_EMAIL)
+_FROM_HEADER = f"{_SENDER_NAME} <{_SENDER_EMAIL}>"
+
+# Logged-in SMTP connections kept open per worker process. A connection is
+# checked out by one task at a time, so concurrent greenlets never share a socket.
+SMTP_POOL_SIZE = 10
+_SMTP_POOL = queue.LifoQueue(maxsize=SMTP_POOL_SIZE)
+
+# A single HTTP session per worker process so repeated scrapes reuse
+# keep-alive connections instead of paying a TCP+TLS handshake every task.
+# Many websites block requests that don't have a valid User-Agent.
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+})
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504)),
+)
+_SESSION.mount("http://", _HTTP_ADAPTER)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+
+# Size of the chunks fed to the HTML parser while the body is still downloading.
+SCRAPE_CHUNK_SIZE = 16384
+
+
+def _open_smtp() -> smtplib.SMTP:
+    server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+    try:
+        server.starttls(context=ssl.create_default_context())
+        server.login(_SENDER_EMAIL, _SENDER_PASSWORD)
+    except Exception:
+        _close_smtp(server)
+        raise
+    return server
+
+
+def _close_smtp(server: smtplib.SMTP):
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+def _checkout_smtp() -> smtplib.SMTP:
+    """Returns a pooled connection that still answers NOOP, or opens a new one."""
+    while True:
+        try:
+            server = _SMTP_POOL.get_nowait()
+        except queue.Empty:
+            return _open_smtp()
+        try:
+            server.noop()
+            return server
+        except (smtplib.SMTPException, OSError):
+            _close_smtp(server)
+
+
+def _checkin_smtp(server: smtplib.SMTP):
+    try:
+        _SMTP_POOL.put_nowait(server)
+    except queue.Full:
+        _close_smtp(server)
+
+
+def _send_message(msg: EmailMessage):
+    """Sends `msg` over a pooled SMTP connection, reconnecting once if the server dropped it."""
+    server = _checkout_smtp()
+    try:
+        try:
+            server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            _close_smtp(server)
+            server = _open_smtp()
+            server.send_message(msg)
+    except Exception:
+        _close_smtp(server)
+        raise
+    _checkin_smtp(server)
+
+
+# Prefork children get worker_process_shutdown; the gevent pool runs in the
+# main process and only gets worker_shutdown.
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def _close_smtp_pool(**kwargs):
+    while True:
+        try:
+            _close_smtp(_SMTP_POOL.get_nowait())
+        except queue.Empty:
+            return
+
+
+def _build_message(recipient: str, subject: str, email_body: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = _FROM_HEADER
+    msg["To"] = recipient
+    msg["Subject"] = subject
+    msg.set_content(email_body)
+    return msg
+
+
+def _format_chain(previous_result: dict | list) -> str:
+    """
+    Formats the result of a preceding scrape step into an email body. In a branching
+    workflow the previous level's results arrive as a list, and their data is combined.
+    """
+    results = previous_result if isinstance(previous_result, list) else [previous_result]
+    scraped_data = [item for result in results if isinstance(result, dict) for item in result.get("scraped_data", [])]
+    if not scraped_data:
+        return "The previous scraping task ran but found no data."
+    return "Here are the results from the web scrape:\n\n" + "\n".join(f"- {item}" for item in scraped_data)
+
+
+def _alias_body(params: dict) -> str | None:
+    """The LLM does not always call the body `body`; accept its usual synonyms too."""
+    return params.get("body") or params.get("content") or params.get("message") or params.get("text")
+
 
 @celery_app.task(name="send_email")
-def send_email(previous_result: dict = None, recipient: str = None, subject: str = None, body: str = None):
+def send_email(previous_result: dict = None, recipient: str = None, subject: str = None, body: str = None, **kwargs):
     """
     A flexible email task that can be used standalone or as part of a chain.
     - If `previous_result` is provided, it will be used to format the email body.
     - If `previous_result` is NOT provided, the direct `body` argument will be used.
+      `content`, `message` and `text` are accepted as aliases for `body`.
     """
-    email_body = None
-
-    # --- NEW: Logic to handle both chained and standalone calls ---
-    if previous_result and isinstance(previous_result, dict):
-        print("--- [TASK: send_email] Running as part of a chain. Formatting previous result. ---")
-        # This is a chained task. Format the body from the previous result.
-        scraped_data = previous_result.get("scraped_data", [])
-        if not scraped_data:
-            email_body = "The previous scraping task ran but found no data."
-        else:
-            email_body = "Here are the results from the web scrape:\n\n"
-            email_body += "\n".join(f"- {item}" for item in scraped_data)
+    if previous_result and isinstance(previous_result, (dict, list)):
+        log.debug("send_email: running as part of a chain, formatting previous result")
+        email_body = _format_chain(previous_result)
     else:
-        print("--- [TASK: send_email] Running as a standalone task. ---")
-        # This is a standalone task. Use the 'body' argument directly.
-        email_body = body
-    # --- END NEW ---
+        log.debug("send_email: running as a standalone task")
+        email_body = _alias_body({"body": body, **kwargs})
 
     # --- Validation ---
     if not recipient:
@@ -50,39 +169,27 @@ def send_email(previous_result: dict = None, recipient: str = None, subject: str
         # raise ValueError("Email body is empty or could not be generated.")
 
     # --- Email Sending Logic (largely unchanged) ---
-    sender_email = os.environ.get("EMAIL_HOST_USER")
-    sender_password = os.environ.get("EMAIL_HOST_PASSWORD")
-    sender_name = os.environ.get("EMAIL_SENDER_NAME", sender_email)
+    msg = _build_message(recipient, subject, email_body)
 
-    if not all([sender_email, sender_password]):
-        raise ValueError("Email credentials not configured in environment variables.")
-
-    msg = EmailMessage()
-    msg["From"] = f"{sender_name} <{sender_email}>"
-    msg["To"] = recipient
-    msg["Subject"] = subject
-    msg.set_content(email_body)
-
-    print(f"--- [TASK: send_email] Attempting to send email to '{recipient}' ---")
+    log.debug("send_email: attempting to send email to %r", recipient)
 
     try:
-        context = ssl.create_default_context()
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.starttls(context=context)
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
+        _send_message(msg)
 
-        success_message = f"Successfully sent email to {recipient}"
-        print(f"--- [TASK: send_email] {success_message} ---")
-        return success_message
+        log.info("send_email: sent email to %r", recipient)
+        return f"Successfully sent email to {recipient}"
 
     except Exception as e:
-        error_message = f"Failed to send email: {e}"
-        print(f"!!! [TASK: send_email] {error_message} !!!")
+        log.error("send_email: failed to send email: %s", e)
         raise e
 
 
 
+def _element_text(element) -> str:
+    """The element's text with each text node stripped and joined, like get_text(strip=True)."""
+    return "".join(text.strip() for text in element.itertext())
+
+
 @celery_app.task(name="scrape_web", bind=True)
 def scrape_web(self, url: str, selector: str = 'body'):
     """
@@ -91,54 +198,58 @@ def scrape_web(self, url: str, selector: str = 'body'):
     :param url: The URL to scrape.
     :param selector: The CSS selector to find elements (e.g., 'h2', '.titleline > a').
     """
-    print(f"--- [TASK: scrape_web] Attempting to scrape URL: {url} with selector: '{selector}' ---")
-    
-    # Many websites block requests that don't have a valid User-Agent
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
+    log.debug("scrape_web: attempting to scrape URL %s with selector %r", url, selector)
 
     try:
         # Set a timeout to prevent the task from hanging indefinitely
-        response = requests.get(url, headers=headers, timeout=15)
-        
-        # Raise an exception for bad status codes (4xx or 5xx)
-        response.raise_for_status()
-
-        # Parse the HTML content of the page
-        soup = BeautifulSoup(response.content, 'html.parser')
+        with _SESSION.get(url, timeout=15, stream=True) as response:
+            # Raise an exception for bad status codes (4xx or 5xx)
+            response.raise_for_status()
+
+            # Only trust the encoding when the server declared one; otherwise
+            # let lxml pick it up from the document's <meta> charset.
+            content_type = response.headers.get("Content-Type", "").lower()
+            encoding = response.encoding if "charset=" in content_type else None
+
+            # Feed the body to lxml's incremental parser as it arrives, so parsing
+            # overlaps the download and the raw page is never held in memory whole.
+            parser = html.HTMLParser(encoding=encoding)
+            for chunk in response.iter_content(chunk_size=SCRAPE_CHUNK_SIZE):
+                parser.feed(chunk)
+            root = parser.close()
+
+        if root is not None:
+            # Script and style bodies aren't page text (BeautifulSoup's get_text() skipped them too).
+            etree.strip_elements(root, "script", "style", with_tail=False)
 
         # Find all elements that match the provided CSS selector
-        elements = soup.select(selector)
+        elements = root.cssselect(selector) if root is not None else []
 
         if not elements:
             message = f"Successfully scraped {url}, but found 0 elements matching selector '{selector}'."
-            print(f"--- [TASK: scrape_web] {message} ---")
+            log.info("scrape_web: %s", message)
             return message
 
         # Extract the text from the found elements, stripping extra whitespace
         # and limiting the results to the first 20 to avoid huge outputs.
-        results = [el.get_text(strip=True) for el in elements[:20]]
+        results = [_element_text(el) for el in elements[:20]]
 
-        success_message = f"Successfully scraped {url}. Found {len(elements)} element(s). Returning first {len(results)}."
-        print(f"--- [TASK: scrape_web] {success_message} ---")
-        print(f"Results: {results}")
+        log.info("scrape_web: scraped %s, found %d element(s), returning first %d", url, len(elements), len(results))
+        log.debug("scrape_web: results: %s", results)
         return {"scraped_data": results}
 
     except requests.exceptions.RequestException as e:
-        error_message = f"Failed to scrape URL {url}. Network error: {e}"
-        print(f"!!! [TASK: scrape_web] {error_message} !!!")
+        log.warning("scrape_web: failed to scrape URL %s, network error: %s", url, e)
         # Retry the task after a delay (e.g., 5 minutes). Can be configured.
         raise self.retry(exc=e, countdown=300)
 
     except Exception as e:
-        error_message = f"An unexpected error occurred during scraping: {e}"
-        print(f"!!! [TASK: scrape_web] {error_message} !!!")
+        log.error("scrape_web: an unexpected error occurred during scraping: %s", e)
         raise e
 
 @celery_app.task(name="call_api")
 def call_api(endpoint: str, payload: dict):
-    print(f"--- TASK: Calling API: {endpoint} ---")
+    log.debug("call_api: calling API %s", endpoint)
     time.sleep(2)
-    print("--- TASK: API call successful. ---")
+    log.info("call_api: API call to %s successful", endpoint)
     return f"API call to {endpoint} returned success"
\ No newline at end of file
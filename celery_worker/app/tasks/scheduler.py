@@ -1,112 +1,226 @@
-from datetime import datetime, timedelta
-import pytz
-from celery import shared_task, chain
-from sqlalchemy.orm import Session
-from croniter import croniter
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from celery import shared_task, chain, group
+from celery.signals import worker_process_init
+from sqlalchemy import select, update
+from sqlalchemy.orm import load_only
 
 from sql_models import Task
-from database import get_db_session
+from scheduling import compute_next_run_at, warm_zones, topological_levels, zone_clock
+from database import AsyncSessionLocal
 from celery_app import celery_app
 
+log = logging.getLogger(__name__)
+
+# How far back a freshly materialized due time may reach, so a task whose cron
+# fired during the current beat interval is not skipped.
+BACKFILL_GRACE = timedelta(seconds=60)
+
+# The most due tasks one tick claims. Any beyond it are the latest-due ones and are
+# picked up by the next tick.
+DISPATCH_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "500"))
+
+# Tools that take the previous step's result as their first argument. In a branching
+# workflow every other step is made immutable so an upstream result can't shift its arguments.
+_RESULT_CONSUMERS = {'send_email'}
+
+def _workflow_signature(workflow: list[dict]):
+    """
+    Builds the Celery canvas for a workflow. A linear workflow stays a plain chain. When
+    steps declare `depends_on`, they are grouped into topological levels: each level runs
+    as a group (the steps in it concurrently), and the levels are chained in order.
+    """
+    signatures = [
+        celery_app.signature(step.get('tool_name'), kwargs=step.get('parameters', {}))
+        for step in workflow
+    ]
+    if all(step.get('depends_on') is None for step in workflow):
+        return chain(signatures)
+
+    stages = []
+    for level in topological_levels([step.get('depends_on') for step in workflow]):
+        level_signatures = []
+        for i in level:
+            sig = signatures[i]
+            if workflow[i].get('tool_name') not in _RESULT_CONSUMERS:
+                sig = sig.set(immutable=True)
+            level_signatures.append(sig)
+        if len(level_signatures) == 1:
+            stages.append(level_signatures[0])
+        else:
+            # The next level waits on this group as a chord, which needs its results stored.
+            stages.append(group(sig.set(ignore_result=False) for sig in level_signatures))
+    return chain(stages)
+
+# One event loop per worker process, kept for its lifetime: the async engine's pooled
+# connections belong to the loop they were opened on, so a fresh asyncio.run() per
+# tick could not reuse them.
+_loop: asyncio.AbstractEventLoop | None = None
+
+def _run(coro):
+    """Runs a coroutine to completion on this process's event loop."""
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coro)
+
+async def mark_run(db, ids: list[int], now: datetime, **values):
+    """
+    Records `now` as the last run of every task in `ids` with a single UPDATE, together
+    with any other column `values` they share, so each row is written once per tick.
+    """
+    if ids:
+        await db.execute(
+            update(Task)
+            .where(Task.id.in_(ids))
+            .values(last_run_at=now, **values)
+            .execution_options(synchronize_session=False)
+        )
+
+async def _load_zones():
+    async with AsyncSessionLocal() as db:
+        warm_zones(await db.scalars(select(Task.timezone).distinct()))
+
+@worker_process_init.connect
+def _warm_zone_cache(**kwargs):
+    """Resolves every timezone already in use before the first tick needs it."""
+    try:
+        _run(_load_zones())
+    except Exception as e:
+        log.warning("Could not pre-load task timezones: %s", e)
+
+def _next_run_at(task: Task, now: datetime, last_run_at: datetime | None) -> datetime | None:
+    """
+    The task's next due time, or None when its schedule can never fire (incomplete,
+    unknown period, bad zone). Errors are logged rather than raised, so one broken
+    schedule can't abort the whole tick.
+    """
+    try:
+        next_run_at = compute_next_run_at(task.schedule_details, task.timezone, now, last_run_at=last_run_at)
+    except Exception as e:
+        log.error("Could not compute next run for Task #%s, deactivating it: %s", task.id, e)
+        return None
+    if next_run_at is None:
+        log.warning("Task #%s has a schedule that can never fire, deactivating it: %s", task.id, task.schedule_details)
+    return next_run_at
+
+async def _claim_due_tasks(now_utc: datetime) -> list[dict]:
+    """
+    Finds, locks and updates the due tasks in one transaction and returns the
+    payloads to dispatch once it has committed.
+    """
+    dispatch_payloads = []
+    async with AsyncSessionLocal.begin() as db:
+        # Tasks created before next_run_at existed have no due time yet. Materialize it
+        # once here so croniter runs per dispatch instead of per task on every tick.
+        tasks_without_due_time = (await db.scalars(
+            select(Task)
+            .options(load_only(Task.id, Task.schedule_details, Task.timezone, Task.last_run_at))
+            .where(Task.is_active == True, Task.next_run_at == None)
+            .with_for_update(skip_locked=True)
+        )).all()
+        backfilled_due_times = []
+        # Tasks whose schedule can never fire are deactivated, so later ticks stop re-selecting them.
+        unschedulable_ids = []
+        # The tick's clock is converted to each zone once, not once per task.
+        backfill_clock = zone_clock(now_utc - BACKFILL_GRACE)
+        for task in tasks_without_due_time:
+            next_run_at = _next_run_at(task, backfill_clock(task.timezone), task.last_run_at)
+            if next_run_at is None:
+                unschedulable_ids.append(task.id)
+            else:
+                backfilled_due_times.append({"id": task.id, "next_run_at": next_run_at})
+        if backfilled_due_times:
+            await db.execute(update(Task), backfilled_due_times)
+        if unschedulable_ids:
+            await db.execute(
+                update(Task)
+                .where(Task.id.in_(unschedulable_ids))
+                .values(is_active=False)
+                .execution_options(synchronize_session=False)
+            )
+
+        # Only fetch the active tasks whose precomputed due time has passed, oldest first,
+        # walking the ix_task_due index. Rows locked by a concurrent beat are skipped
+        # rather than waited on, so two beats never dispatch the same task. Only the
+        # columns this tick reads are loaded.
+        tasks_due = (await db.scalars(
+            select(Task)
+            .options(load_only(Task.id, Task.task_name, Task.schedule_details, Task.timezone, Task.workflow))
+            .where(Task.is_active == True, Task.next_run_at <= now_utc)
+            .order_by(Task.next_run_at)
+            .limit(DISPATCH_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )).all()
+        log.debug("Found %d due tasks.", len(tasks_due))
+
+        # State changes are collected here and written in bulk after the loop,
+        # instead of dirtying each ORM object and flushing one UPDATE per row.
+        # Every due task lands in exactly one of these, so each row is updated once.
+        finished_ids = []
+        recurring_due_times = []
+        clock = zone_clock(now_utc)
+        for task in tasks_due:
+            log.debug("Task #%s (%r) is due. Preparing payload.", task.id, task.task_name)
+            if task.schedule_details.get('type') == 'datetime':
+                finished_ids.append(task.id) # One-time task, mark for deactivation
+            else:
+                next_run_at = _next_run_at(task, clock(task.timezone), now_utc)
+                if next_run_at is None:
+                    finished_ids.append(task.id) # It runs this once more, then stops recurring.
+                else:
+                    recurring_due_times.append({"id": task.id, "last_run_at": now_utc, "next_run_at": next_run_at})
+
+            # We still create the clean payload for dispatching later.
+            dispatch_payloads.append({
+                "id": task.id,
+                "workflow": task.workflow
+            })
+
+        await mark_run(db, finished_ids, now_utc, is_active=False, next_run_at=None)
+        if recurring_due_times:
+            # A list of parameter sets keyed by primary key runs as a single executemany.
+            await db.execute(update(Task), recurring_due_times)
+
+        if not dispatch_payloads:
+            log.debug("No tasks are due at this time.")
+    # Leaving the block commits the state changes, which releases the locks and
+    # makes them permanent and visible before anything is dispatched.
+    return dispatch_payloads
+
 @shared_task(name="dispatch_periodic_tasks")
 def dispatch_periodic_tasks():
     """
     The main scheduler task. This version uses a robust two-phase commit pattern
     to find, lock, update, and then dispatch tasks, preventing re-execution.
     """
-    now_utc = datetime.now(pytz.utc)
-    print(f"\n--- [Scheduler Beat @ {now_utc.isoformat()}] ---")
-    
-    dispatch_payloads = []
+    now_utc = datetime.now(timezone.utc)
+    log.debug("Scheduler beat @ %s", now_utc)
     
     # --- PHASE 1: Find, Lock, and Update Tasks Atomically ---
-    db_session_gen = get_db_session()
-    db: Session = next(db_session_gen)
     try:
-        # Query for all potentially due tasks and lock the rows for update.
-        # This prevents other transactions from interfering.
-        tasks_to_evaluate = db.query(Task).filter(Task.is_active == True).with_for_update().all()
-        print(f"Found {len(tasks_to_evaluate)} active tasks to evaluate.")
-
-        for task in tasks_to_evaluate:
-            schedule_details = task.schedule_details
-            schedule_type = schedule_details.get('type')
-            is_due = False
-
-            # --- Evaluation logic (this part is correct) ---
-            if schedule_type == 'cron':
-                cron_str = schedule_details.get('value')
-                if not cron_str: continue
-                task_tz = pytz.timezone(task.timezone)
-                base_time = now_utc.astimezone(task_tz)
-                itr = croniter(cron_str, base_time)
-                prev_run_time = itr.get_prev(datetime)
-                if (base_time - prev_run_time).total_seconds() <= 60:
-                    is_due = True
-
-            elif schedule_type == 'interval':
-                every = schedule_details.get('every')
-                period = schedule_details.get('period')
-                if not all([every, period]): continue
-                if task.last_run_at:
-                    next_run_time = task.last_run_at + timedelta(**{period: every})
-                else:
-                    next_run_time = now_utc
-                if next_run_time <= now_utc:
-                    is_due = True
-                    task.last_run_at = now_utc # Mark for update
-
-            elif schedule_type == 'datetime':
-                scheduled_time_str = schedule_details.get('value')
-                if not scheduled_time_str: continue
-                scheduled_time_naive = datetime.fromisoformat(scheduled_time_str)
-                task_tz = pytz.timezone(task.timezone)
-                scheduled_time_aware = task_tz.localize(scheduled_time_naive)
-                if scheduled_time_aware <= now_utc:
-                    is_due = True
-                    task.is_active = False # Mark for deactivation
-            
-            if is_due:
-                print(f"  -> Task #{task.id} ('{task.task_name}') is due. Preparing payload.")
-                # We still create the clean payload for dispatching later.
-                dispatch_payloads.append({
-                    "id": task.id,
-                    "workflow": task.workflow
-                })
-        
-        # If we found any due tasks, commit their state changes.
-        # This commit releases the locks and makes the changes permanent and visible.
-        if dispatch_payloads:
-            print(f"Committing state changes for {len(dispatch_payloads)} due tasks.")
-            db.commit()
-        else:
-            print("No tasks are due at this time.")
-
+        dispatch_payloads = _run(_claim_due_tasks(now_utc))
     except Exception as e:
-        print(f"!!! SCHEDULER ERROR during evaluation/commit phase: {e} !!!")
-        db.rollback()
-    finally:
-        db.close()
+        log.error("Scheduler error during evaluation/commit phase: %s", e)
+        # Nothing was committed, so nothing may be dispatched.
+        dispatch_payloads = []
 
     # --- PHASE 2: Dispatch the tasks using the clean payloads ---
     # This happens *after* the database transaction is completely finished.
     if dispatch_payloads:
-        print("Dispatching workflows to Redis...")
-        for payload in dispatch_payloads:
-            try:
-                task_signatures = []
-                for step in payload['workflow']:
-                    sig = celery_app.signature(
-                        step.get('tool_name'),
-                        kwargs=step.get('parameters', {})
-                    )
-                    task_signatures.append(sig)
-                
-                if task_signatures:
-                    workflow_chain = chain(task_signatures)
-                    workflow_chain.apply_async()
-                    print(f"  -> Successfully dispatched workflow for task #{payload['id']}")
-            except Exception as e:
-                print(f"!!! FAILED TO DISPATCH Task #{payload['id']}: {e} !!!")
+        log.debug("Dispatching workflows to Redis...")
+        # Publish every due workflow over one pooled broker connection instead of
+        # acquiring a connection per workflow.
+        with celery_app.connection_or_acquire() as conn:
+            for payload in dispatch_payloads:
+                workflow = payload['workflow']
+                try:
+                    if workflow:
+                        _workflow_signature(workflow).apply_async(connection=conn)
+                        log.info("Dispatched workflow for task #%s", payload['id'])
+                except Exception as e:
+                    log.error("Failed to dispatch Task #%s: %s", payload['id'], e)
     
-    print("--- [Scheduler Beat Finished] ---")
\ No newline at end of file
+    log.debug("Scheduler beat finished")
\ No newline at end of file
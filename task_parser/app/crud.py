@@ -1,31 +1,51 @@
+from datetime import datetime, timezone
+from sqlalchemy import insert, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from . import sql_models, schemas
+from .scheduling import compute_next_run_at
 # from .schemas import TaskUpdate
 from .schemas import TaskUpdate
 
-async def create_task(db: AsyncSession, task_data: schemas.ScheduleTaskTool) -> sql_models.Task:
+def _task_rows(payloads: list[schemas.TaskCreate]) -> list[dict]:
+    """Turns validated tasks into column dictionaries ready for an INSERT."""
+    now = datetime.now(timezone.utc)
+    rows = []
+    for task_data in payloads:
+        # One dump per task turns the nested Pydantic models into the plain
+        # dictionaries stored in the JSON columns of our database.
+        data = task_data.model_dump(mode="json", include={"task_name", "timezone", "workflow", "schedule"})
+        rows.append({
+            "task_name": data["task_name"],
+            "workflow": data["workflow"],
+            "schedule_details": data["schedule"],
+            "timezone": data["timezone"],
+            "next_run_at": compute_next_run_at(data["schedule"], data["timezone"], now),
+        })
+    return rows
+
+async def create_tasks_bulk(
+    db: AsyncSession, payloads: list[schemas.TaskCreate]
+) -> list[sql_models.Task]:
+    """
+    Inserts several tasks parsed by the Function Calling LLM in one
+    INSERT ... RETURNING statement and a single commit.
+    """
+    rows = _task_rows(payloads)
+    # RETURNING the whole row hands back server-generated columns (id, created_at)
+    # with the insert itself, so no follow-up refresh is needed.
+    result = await db.scalars(insert(sql_models.Task).returning(sql_models.Task), rows)
+    db_tasks = list(result.all())
+    await db.commit()
+    return db_tasks
+
+async def create_task(db: AsyncSession, task_data: schemas.TaskCreate) -> sql_models.Task:
     """
     Creates a new task record in the database from the structured data
     provided by the Function Calling LLM.
     """
-    # Convert the Pydantic models for the workflow and schedule into plain dictionaries
-    # so they can be stored in the JSON columns of our database.
-    workflow_dict = [step.model_dump() for step in task_data.workflow]
-    schedule_dict = task_data.schedule
-
-    # Create the SQLAlchemy Task instance, mapping the fields correctly.
-    db_task = sql_models.Task(
-        task_name=task_data.task_name,
-        workflow=workflow_dict,
-        schedule_details=schedule_dict,
-        timezone=task_data.timezone
-    )
-    
-    db.add(db_task)
-    await db.commit()
-    await db.refresh(db_task)
-    return db_task
+    db_tasks = await create_tasks_bulk(db, [task_data])
+    return db_tasks[0]
 
 async def get_tasks(db: AsyncSession, skip: int = 0, limit: int = 100) -> list[sql_models.Task]:
     """
@@ -60,8 +80,22 @@ async def update_task(
     # .model_dump(exclude_unset=True) is important: it only includes fields
     # that were actually provided in the request body.
     update_data_dict = update_data.model_dump(exclude_unset=True)
-    for key, value in update_data_dict.items():
-        setattr(task, key, value)
+    if not update_data_dict:
+        return task
+    # A resumed task needs a fresh due time, or the scheduler will never pick it up again.
+    if update_data_dict.get("is_active"):
+        update_data_dict["next_run_at"] = compute_next_run_at(
+            task.schedule_details, task.timezone, datetime.now(timezone.utc), last_run_at=task.last_run_at
+        )
+    # RETURNING hands back the updated row (including updated_at) with the UPDATE itself,
+    # so no refresh round trip is needed afterwards.
+    result = await db.scalars(
+        update(sql_models.Task)
+        .where(sql_models.Task.id == task.id)
+        .values(**update_data_dict)
+        .returning(sql_models.Task),
+        execution_options={"populate_existing": True},
+    )
+    task = result.one()
     await db.commit()
-    await db.refresh(task)
-    return task
\ No newline at end of file
+    return task
@@ -1,11 +1,50 @@
 import os
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+import orjson
+from asyncio import current_task
+from uuid import uuid4
+from sqlalchemy.ext.asyncio import (
+    create_async_engine, async_sessionmaker, async_scoped_session, AsyncSession
+)
 
 DATABASE_URL = os.environ["DATABASE_URL"]
-engine = create_async_engine(DATABASE_URL)
+# A blocking driver would stall the event loop on every query.
+if not DATABASE_URL.startswith("postgresql+asyncpg://"):
+    raise ValueError("DATABASE_URL must use the asyncpg driver (postgresql+asyncpg://...).")
+
+# Set DB_PGBOUNCER=1 when DATABASE_URL points at PgBouncer in transaction mode: a server
+# connection can change between transactions, so a cached prepared statement may be gone.
+BEHIND_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "0") == "1"
+
+# Sized for concurrent /parse-task traffic; every knob can be lowered per deployment.
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=int(os.environ.get("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", "30")),
+    pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+    pool_pre_ping=True,  # Drops connections Postgres closed while they sat idle in the pool
+    # Encode/decode the workflow and schedule JSON columns with orjson instead of stdlib json.
+    json_serializer=lambda value: orjson.dumps(value).decode(),
+    json_deserializer=orjson.loads,
+    connect_args={
+        # SQLAlchemy's per-connection prepared statement cache lets repeated queries skip
+        # parsing, so asyncpg's own statement cache would only duplicate it.
+        "statement_cache_size": 0,
+        "prepared_statement_cache_size": 0 if BEHIND_PGBOUNCER else 256,
+        # Unique names keep statements prepared through a transaction-mode pooler from
+        # colliding with ones another client prepared on the same server connection.
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+    },
+)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+# Each request is served by its own asyncio task, so keying the registry on the
+# current task gives every request exactly one session, shared by everything it calls.
+AsyncScopedSession = async_scoped_session(async_session_maker, scopefunc=current_task)
 
 async def get_db() -> AsyncSession:
-    """Dependency to get an async database session."""
-    async with async_session_maker() as session:
-        yield session
\ No newline at end of file
+    """Dependency to get the current request's async database session."""
+    try:
+        yield AsyncScopedSession()
+    finally:
+        # Closes the session and returns its connection to the pool.
+        await AsyncScopedSession.remove()
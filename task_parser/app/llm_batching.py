@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+import os
+
+# A batch takes at most LLM_MAX_BATCH of the prompts already waiting; it never waits for more.
+MAX_BATCH = int(os.environ.get("LLM_MAX_BATCH", "8"))
+
+
+class PromptBatcher:
+    """
+    Collects concurrent prompts for one Gemini model and sends them as batches.
+
+    The google-generativeai SDK has no batched function-calling endpoint, so a batch
+    is issued as concurrent requests over the model's shared client. Identical prompts
+    within a batch (e.g. a double-submitted form) share a single call. A batch is sent
+    as soon as the collector picks up its first prompt, so a lone request is not delayed.
+    """
+
+    def __init__(self, model):
+        self._model = model
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._collector: asyncio.Task | None = None
+        self._in_flight: set[asyncio.Task] = set()
+
+    def start(self):
+        """Starts the collector; must be called from the running event loop."""
+        self._collector = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        """
+        Stops collecting, fails prompts still waiting in the queue, and waits for
+        batches that are already in flight.
+        """
+        if self._collector is not None:
+            self._collector.cancel()
+            await asyncio.gather(self._collector, return_exceptions=True)
+            self._collector = None
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("batcher stopped"))
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    async def submit(self, prompt: str):
+        """Queues a prompt and waits for the model's response to it."""
+        if self._collector is None or self._collector.done():
+            raise RuntimeError("PromptBatcher is not running; call start() first.")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    async def _collect(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < MAX_BATCH and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            # Send in the background so the next batch can start collecting right away.
+            task = asyncio.create_task(self._run_batch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _generate(self, prompt: str):
+        """
+        Streams the model's reply and returns the first chunk that carries a function
+        call, instead of waiting for the whole response to finish generating. Returns
+        None if the stream ends without one.
+        """
+        stream = await self._model.generate_content_async(prompt, stream=True)
+        # Close the stream on every exit so breaking out early doesn't leave it open.
+        async with contextlib.aclosing(aiter(stream)) as chunks:
+            async for chunk in chunks:
+                parts = chunk.candidates[0].content.parts if chunk.candidates else []
+                if parts and parts[0].function_call:
+                    return chunk
+        return None
+
+    async def _run_batch(self, batch: list[tuple[str, asyncio.Future]]):
+        waiters: dict[str, list[asyncio.Future]] = {}
+        for prompt, future in batch:
+            waiters.setdefault(prompt, []).append(future)
+
+        responses = await asyncio.gather(
+            *(self._generate(prompt) for prompt in waiters),
+            return_exceptions=True,
+        )
+        for futures, response in zip(waiters.values(), responses):
+            for future in futures:
+                if future.done():  # The request was cancelled while waiting.
+                    continue
+                if isinstance(response, BaseException):
+                    future.set_exception(response)
+                else:
+                    future.set_result(response)
@@ -1,17 +1,25 @@
 import os
+import re
+import copy
+import orjson
+from async_lru import alru_cache
 import google.generativeai as genai
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import ValidationError
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError, TypeAdapter
+from sqlalchemy import select, text
 from sqlalchemy.ext.asyncio import AsyncSession
 from contextlib import asynccontextmanager
-from google.protobuf.struct_pb2 import Value
+from google.protobuf.json_format import MessageToDict
 from datetime import datetime
-import pytz
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 
 # --- Local Imports ---
 from . import crud, schemas, sql_models
-from .database import engine, get_db
+from .database import engine, async_session_maker, get_db
+from .llm_batching import PromptBatcher
+from .scheduling import resolve_zone, warm_zones
 
 # --- Timezone Sanitization Map ---
 TIMEZONE_ABBREVIATION_MAP = {
@@ -21,185 +29,327 @@ TIMEZONE_ABBREVIATION_MAP = {
     "GMT": "Etc/GMT", "UTC": "UTC",
 }
 
-# --- Robust Converter for Google's ProtoBuf Objects ---
-def to_dict(data):
-    """
-    Recursively converts Google's special MapComposite and RepeatedComposite
-    objects into standard Python dictionaries and lists.
-    """
-    if hasattr(data, "items"):
-        return {key: to_dict(value) for key, value in data.items()}
-    elif isinstance(data, Value):
-        return data.string_value or data.number_value or data.bool_value or None
-    elif hasattr(data, "__iter__") and not isinstance(data, str):
-        return [to_dict(item) for item in data]
+# --- Intelligent Schedule Formatter with Defensive Logic (THE FIX) ---
+def _as_int(value, default=None):
+    """Returns `value` as an int when it is a whole number (or a digit string), else `default`."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        # Numbers in the function-call args arrive as floats, e.g. 17.0 for 5pm.
+        return int(value)
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return default
+
+# Each handler formats one shape of raw LLM schedule. A handler returns None when the
+# values it was given turn out to be unusable, which sends the schedule to the fallback.
+
+def _format_interval(raw_schedule: dict, now_in_user_tz: datetime) -> dict | None:
+    # INTERVAL ("every N period") - This is the most distinct.
+    print("Formatter: Classified as INTERVAL.")
+    return { "type": "interval", "every": int(raw_schedule['every']), "period": raw_schedule['period'] }
+
+def _format_today_time(raw_schedule: dict, now_in_user_tz: datetime) -> dict | None:
+    # A time for TODAY ("at 5pm", "at 11:44"). Classified before the general datetime
+    # shape to handle cases like 'day': 'today'.
+    hour_val = _as_int(raw_schedule['hour'])
+    minute_val = _as_int(raw_schedule['minute'])
+    if hour_val is None or minute_val is None:
+        return None
+    dt_object = now_in_user_tz.replace(
+        hour=hour_val, minute=minute_val,
+        second=0, microsecond=0
+    )
+    print(f"Formatter: Classified as 'today at time' DATETIME: {dt_object.isoformat()}")
+    return {"type": "datetime", "value": dt_object.replace(tzinfo=None, microsecond=0).isoformat()}
+
+def _format_explicit_datetime(raw_schedule: dict, now_in_user_tz: datetime) -> dict | None:
+    # Explicit DATETIME (year, month, or day is present)
+    # Gracefully handle non-integer values by trying to convert them
+    try:
+        dt_object = datetime(
+            year=int(raw_schedule.get('year', now_in_user_tz.year)),
+            month=int(raw_schedule.get('month', now_in_user_tz.month)),
+            day=int(raw_schedule.get('day', now_in_user_tz.day)),
+            hour=int(raw_schedule.get('hour', 0)),
+            minute=int(raw_schedule.get('minute', 0))
+        )
+    except (ValueError, TypeError):
+        # If conversion fails (e.g., day='today'), fall through to the safe 'now' default
+        print(f"Formatter: Failed to parse explicit date parts, falling back. Parts were: {raw_schedule}")
+        return None
+    print(f"Formatter: Classified as explicit DATETIME: {dt_object.isoformat()}")
+    return {"type": "datetime", "value": dt_object.replace(tzinfo=None, microsecond=0).isoformat()}
+
+_VALID_DOW = frozenset({'sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat', '*'})
+
+def _format_cron(raw_schedule: dict, now_in_user_tz: datetime) -> dict | None:
+    # A recurring CRON schedule
+    print("Formatter: Classified as CRON.")
+    day_of_week = raw_schedule.get('day_of_week', '*')
+    if _as_int(day_of_week) is None and str(day_of_week).lower() not in _VALID_DOW:
+        day_of_week = '*'
     else:
-        return data
+        day_of_week = _as_int(day_of_week, day_of_week)
+    minute = _as_int(raw_schedule.get('minute', '0'), '*')
+    hour = _as_int(raw_schedule.get('hour', '*'), '*')
+    day_of_month = raw_schedule.get('day_of_month', '*')
+    month = raw_schedule.get('month', '*')
+
+    cron_str = f"{minute} {hour} {_as_int(day_of_month, day_of_month)} {_as_int(month, month)} {day_of_week}"
+    print(f"  -> Generated CRON string: '{cron_str}'")
+    return {"type": "cron", "value": cron_str}
+
+def _format_fallback(raw_schedule: dict, now_in_user_tz: datetime) -> dict:
+    # --- SAFE FALLBACK ---
+    print("Formatter: Ambiguous schedule. Defaulting to a one-time 'run now' DATETIME task.")
+    return {"type": "datetime", "value": now_in_user_tz.replace(tzinfo=None, microsecond=0).isoformat()}
+
+# One bit per schedule key the formatter cares about.
+_SHAPE_KEYS = ('every', 'period', 'year', 'month', 'day', 'hour', 'minute', 'day_of_week', 'day_of_month')
+_SHAPE_BITS = {key: 1 << i for i, key in enumerate(_SHAPE_KEYS)}
+
+def _classify_shape(mask: int):
+    """Applies the formatter's priority order to one combination of present keys."""
+    has = lambda *keys: all(mask & _SHAPE_BITS[k] for k in keys)
+    if has('every', 'period'):
+        return _format_interval
+    if has('hour', 'minute') and not (has('year') or has('month')):
+        return _format_today_time
+    if has('year') or has('month') or has('day'):
+        return _format_explicit_datetime
+    if has('day_of_week') or has('day_of_month'):
+        return _format_cron
+    return _format_fallback
+
+# Every possible key combination is classified once at import.
+_SHAPE_DISPATCH = [_classify_shape(mask) for mask in range(1 << len(_SHAPE_KEYS))]
 
-# --- Intelligent Schedule Formatter with Defensive Logic (THE FIX) ---
 def format_schedule_from_llm(raw_schedule: dict, timezone_str: str) -> dict:
     """
     Takes the raw, flat dictionary from the LLM and intelligently converts it
     into the structured {'type': '...', 'value': '...'} format. This version
     handles non-integer values from the LLM gracefully.
     """
-    try:
-        user_tz = pytz.timezone(timezone_str)
-    except pytz.UnknownTimeZoneError:
-        user_tz = pytz.utc
-    
-    now_in_user_tz = datetime.now(user_tz)
-
-    # --- NEW, SAFER LOGIC ORDER ---
-
-    # Priority 1: INTERVAL ("every N period") - This is the most distinct.
-    if 'every' in raw_schedule and 'period' in raw_schedule:
-        print("Formatter: Classified as INTERVAL.")
-        return { "type": "interval", "every": int(raw_schedule['every']), "period": raw_schedule['period'] }
-
-    # Priority 2: A time for TODAY ("at 5pm", "at 11:44")
-    # We check this before the general datetime block to handle cases like 'day': 'today'.
-    elif 'hour' in raw_schedule and 'minute' in raw_schedule and not ('year' in raw_schedule or 'month' in raw_schedule):
-        hour_val = raw_schedule.get('hour', 0)
-        minute_val = raw_schedule.get('minute', 0)
-        if str(hour_val).isdigit() and str(minute_val).isdigit():
-            dt_object = now_in_user_tz.replace(
-                hour=int(hour_val), minute=int(minute_val),
-                second=0, microsecond=0
-            )
-            print(f"Formatter: Classified as 'today at time' DATETIME: {dt_object.isoformat()}")
-            return {"type": "datetime", "value": dt_object.strftime('%Y-%m-%dT%H:%M:%S')}
-
-    # Priority 3: Explicit DATETIME (year, month, or day is present)
-    elif 'year' in raw_schedule or 'month' in raw_schedule or 'day' in raw_schedule:
-        # Gracefully handle non-integer values by trying to convert them
-        try:
-            dt_object = datetime(
-                year=int(raw_schedule.get('year', now_in_user_tz.year)),
-                month=int(raw_schedule.get('month', now_in_user_tz.month)),
-                day=int(raw_schedule.get('day', now_in_user_tz.day)),
-                hour=int(raw_schedule.get('hour', 0)),
-                minute=int(raw_schedule.get('minute', 0))
-            )
-            print(f"Formatter: Classified as explicit DATETIME: {dt_object.isoformat()}")
-            return {"type": "datetime", "value": dt_object.strftime('%Y-%m-%dT%H:%M:%S')}
-        except (ValueError, TypeError):
-            # If conversion fails (e.g., day='today'), fall through to the safe 'now' default
-            print(f"Formatter: Failed to parse explicit date parts, falling back. Parts were: {raw_schedule}")
-            pass
-
-    # Priority 4: A recurring CRON schedule
-    elif 'day_of_week' in raw_schedule or 'day_of_month' in raw_schedule:
-        print("Formatter: Classified as CRON.")
-        day_of_week = raw_schedule.get('day_of_week', '*')
-        valid_dow = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat', '*']
-        if not str(day_of_week).isdigit() and str(day_of_week).lower() not in valid_dow:
-            day_of_week = '*'
-        
-        cron_parts = {
-            'minute': raw_schedule.get('minute', '0'), 'hour': raw_schedule.get('hour', '*'),
-            'day_of_month': raw_schedule.get('day_of_month', '*'), 'month_of_year': raw_schedule.get('month', '*'),
-            'day_of_week': day_of_week
-        }
-        if not str(cron_parts['minute']).isdigit(): cron_parts['minute'] = '*'
-        if not str(cron_parts['hour']).isdigit(): cron_parts['hour'] = '*'
-        
-        cron_str = "{minute} {hour} {day_of_month} {month_of_year} {day_of_week}".format(**cron_parts)
-        print(f"  -> Generated CRON string: '{cron_str.strip()}'")
-        return {"type": "cron", "value": cron_str.strip()}
+    now_in_user_tz = datetime.now(resolve_zone(timezone_str))
 
-    # --- SAFE FALLBACK ---
-    else:
-        print("Formatter: Ambiguous schedule. Defaulting to a one-time 'run now' DATETIME task.")
-        dt_object = now_in_user_tz
-        return {"type": "datetime", "value": dt_object.strftime('%Y-%m-%dT%H:%M:%S')}
+    mask = 0
+    for key in raw_schedule.keys() & _SHAPE_BITS.keys():
+        mask |= _SHAPE_BITS[key]
+    return (
+        _SHAPE_DISPATCH[mask](raw_schedule, now_in_user_tz)
+        or _format_fallback(raw_schedule, now_in_user_tz)
+    )
 
 
 # --- Database Setup & Lifespan Event Handler ---
 async def create_db_and_tables():
     async with engine.begin() as conn:
         await conn.run_sync(sql_models.Base.metadata.create_all)
+        # create_all skips a tasks table that already exists; bring an older one up to date.
+        for check, *statements in sql_models.SCHEMA_UPGRADES:
+            if not await conn.scalar(text(check)):
+                continue
+            try:
+                # A savepoint per step, so one that fails doesn't roll back the others.
+                async with conn.begin_nested():
+                    for statement in statements:
+                        await conn.execute(text(statement))
+                print(f"Applied schema upgrade: {statements[-1]}")
+            except Exception as e:
+                print(f"Could not apply schema upgrade '{statements[-1]}', leaving it for now: {e}")
+
+async def install_updated_at_trigger():
+    """(Re)installs the trigger that maintains tasks.updated_at; the ORM no longer sets it."""
+    try:
+        async with engine.begin() as conn:
+            for statement in sql_models.UPDATED_AT_TRIGGER:
+                await conn.execute(text(statement))
+    except Exception as e:
+        print(f"Could not install the updated_at trigger: {e}")
+
+async def warm_timezone_cache():
+    """Resolves every zone already stored, so no request pays for reading its zone file."""
+    warm_zones(TIMEZONE_ABBREVIATION_MAP.values())
+    try:
+        async with async_session_maker() as db:
+            warm_zones(await db.scalars(select(sql_models.Task.timezone).distinct()))
+    except Exception as e:
+        print(f"Could not pre-load task timezones: {e}")
+
+# Checking every table against pg_catalog is only needed on a fresh database; deployments
+# whose schema is managed elsewhere can skip it with CREATE_TABLES_ON_START=0.
+CREATE_TABLES_ON_START = os.getenv("CREATE_TABLES_ON_START", "1") == "1"
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("Starting up and creating database tables for workflow schema...")
-    await create_db_and_tables()
+    if CREATE_TABLES_ON_START:
+        print("Starting up and creating database tables for workflow schema...")
+        await create_db_and_tables()
+    await install_updated_at_trigger()
+    await warm_timezone_cache()
+    gemini_batcher.start()
     yield
     print("Shutting down...")
+    await gemini_batcher.stop()
+
+class OrjsonResponse(JSONResponse):
+    """JSON response rendered with orjson, which serializes datetimes natively."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
 
 # --- FastAPI Application Initialization ---
 app = FastAPI(
     title="AI Task Parser Service (Function Calling)",
     description="Parses tasks using Gemini's native Function Calling and saves them as workflows.",
     version="2.2.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=OrjsonResponse,
 )
 
 # --- Configure CORS ---
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:3000"],
+    # Compiled once by the middleware; extend the alternation as more frontends are added.
+    allow_origin_regex=os.getenv("CORS_ORIGIN_REGEX", r"^http://localhost:3000$"),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 # --- Gemini Client Configuration ---
+# Built once and shared by every request. Parsing a schedule should be deterministic.
+GENERATION_CONFIG = genai.GenerationConfig(temperature=0.0)
+
 try:
     genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
     gemini_model = genai.GenerativeModel(
         "gemini-1.5-flash",
         system_instruction="You are a helpful assistant that helps users schedule tasks...",
-        tools=[schemas.ScheduleTaskTool]
+        tools=[schemas.ScheduleTaskTool],
+        generation_config=GENERATION_CONFIG,
     )
+    # Concurrent /parse-task requests are collected and sent to Gemini together.
+    gemini_batcher = PromptBatcher(gemini_model)
 except Exception as e:
     print(f"!!! FATAL ERROR during Gemini model initialization: {e} !!!")
     raise
 
+# --- Gemini Call Helpers ---
+# Prompts whose meaning depends on when they are sent must always go to the model.
+_TIME_RELATIVE_WORDS = frozenset({"today", "now", "tomorrow", "tonight"})
+
+async def _function_call_args(user_prompt: str) -> dict | None:
+    """Asks Gemini for the ScheduleTaskTool call; returns its arguments, or None if it made none."""
+    # The batcher only hands back a chunk that holds a function call, or None.
+    response = await gemini_batcher.submit(user_prompt)
+    if response is None:
+        return None
+    response_part = response.candidates[0].content.parts[0]
+    # The arguments arrive as a protobuf Struct; convert the raw message in one pass
+    # rather than walking the proto-plus wrappers element by element.
+    return MessageToDict(response_part.function_call._pb.args, preserving_proto_field_name=True)
+
+class _NoFunctionCall(Exception):
+    """Raised instead of returning None, since alru_cache keeps results but not exceptions."""
+
+# Only the small args dict is kept, not the whole response. The prompt is used verbatim
+# as the key (it already ends with the timezone), since it carries email text. A reply
+# without a function call is not cached, so one odd answer isn't repeated for an hour.
+@alru_cache(maxsize=1024, ttl=3600)
+async def _cached_function_call_args(user_prompt: str) -> dict:
+    args = await _function_call_args(user_prompt)
+    if args is None:
+        raise _NoFunctionCall
+    return args
+
+async def get_function_call_args(user_prompt: str) -> dict | None:
+    """Like _function_call_args, but repeats of a time-independent prompt skip the model."""
+    if not _TIME_RELATIVE_WORDS.isdisjoint(re.findall(r"[a-z]+", user_prompt.lower())):
+        return await _function_call_args(user_prompt)
+    try:
+        # Callers mutate the dict, so never hand out the cached instance itself.
+        return copy.deepcopy(await _cached_function_call_args(user_prompt.strip()))
+    except _NoFunctionCall:
+        return None
+
+# --- Request Body Parsing ---
+def json_body(adapter: TypeAdapter):
+    """
+    Dependency that validates the raw request bytes with `adapter.validate_json`, so the
+    body is parsed straight into the model instead of via an intermediate dict.
+    """
+    async def dependency(request: Request):
+        try:
+            return adapter.validate_json(await request.body())
+        except ValidationError as e:
+            # Same error shape FastAPI reports for a typed body parameter.
+            raise RequestValidationError(
+                [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+            )
+    return dependency
+
+def json_body_schema(model) -> dict:
+    """Documents a json_body() parameter in OpenAPI, as a typed body parameter would be."""
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": model.model_json_schema()}}}}
+
+# --- Response Serialization ---
+def json_response(adapter: TypeAdapter, value) -> Response:
+    """
+    Validates ORM rows with `adapter` once and dumps them straight to JSON bytes.
+    Returning a model from the endpoint instead would have FastAPI dump it to a dict,
+    validate it again against response_model, and only then encode it.
+    """
+    return Response(adapter.dump_json(adapter.validate_python(value)), media_type="application/json")
+
 # --- API Endpoints ---
 @app.get("/")
 def read_root():
     return {"status": "AI Task Parser (Function Calling) is running"}
 
-@app.post("/parse-task", response_model=schemas.Task)
+@app.post("/parse-task", response_model=schemas.Task, openapi_extra=json_body_schema(schemas.TaskRequest))
 async def parse_and_create_task(
-    request: schemas.TaskRequest,
+    request: schemas.TaskRequest = Depends(json_body(schemas.TASK_REQUEST_ADAPTER)),
     db: AsyncSession = Depends(get_db)
 ):
     try:
         sanitized_timezone = TIMEZONE_ABBREVIATION_MAP.get(request.timezone.upper(), request.timezone)
         user_prompt = f"{request.prompt} (The user's local timezone is {sanitized_timezone})"
         
-        response = await gemini_model.generate_content_async(user_prompt)
-        
-        response_part = response.candidates[0].content.parts[0]
-        if not response_part.function_call:
+        # No DB connection is held while Gemini is thinking; the session checks one out
+        # only when the task is inserted.
+        args_dict = await get_function_call_args(user_prompt)
+        if args_dict is None:
             raise HTTPException(status_code=400, detail="Could not understand the request into a schedulable task.")
 
-        function_call_args = response_part.function_call.args
-        args_dict = to_dict(function_call_args)
-        
-        raw_schedule = args_dict.pop('schedule', {})
-        formatted_schedule = format_schedule_from_llm(raw_schedule, sanitized_timezone)
-        args_dict['schedule'] = formatted_schedule
-        
-        validated_task_data = schemas.ScheduleTaskTool(**args_dict)
+        # Reformat the schedule in place and validate the dict as-is, instead of popping,
+        # re-inserting and unpacking it into keyword arguments.
+        args_dict['schedule'] = format_schedule_from_llm(args_dict.get('schedule') or {}, sanitized_timezone)
+        validated_task_data = schemas.TASK_CREATE_ADAPTER.validate_python(args_dict)
         
         db_task_model = await crud.create_task(db=db, task_data=validated_task_data)
         
         print(f"Successfully created workflow task #{db_task_model.id} ('{db_task_model.task_name}')")
-        return db_task_model
 
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=f"The LLM's output could not be validated. Error: {e}")
     except Exception as e:
         print(f"An unexpected error occurred in /parse-task: {type(e).__name__}: {e}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred while parsing the task.")
+    return json_response(schemas.TASK_READ_ADAPTER, db_task_model)
 
 @app.get("/tasks", response_model=list[schemas.Task])
 async def read_tasks(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
-    tasks = await crud.get_tasks(db, skip=skip, limit=limit)
-    return tasks
+    tasks = []
+    for task in await crud.get_tasks(db, skip=skip, limit=limit):
+        # One malformed row (e.g. a NULL name from an older version) must not fail the whole list.
+        try:
+            tasks.append(schemas.TASK_READ_ADAPTER.validate_python(task))
+        except ValidationError as e:
+            print(f"Skipping task #{task.id} in /tasks: {e}")
+    return Response(schemas.TASK_LIST_ADAPTER.dump_json(tasks), media_type="application/json")
 
 
 
@@ -217,15 +367,16 @@ async def delete_task(task_id: int, db: AsyncSession = Depends(get_db)):
 
 
 # --- NEW: Endpoint to update a task's status (e.g., pause/resume) ---
-@app.patch("/tasks/{task_id}", response_model=schemas.Task)
+@app.patch("/tasks/{task_id}", response_model=schemas.Task, openapi_extra=json_body_schema(schemas.TaskUpdate))
 async def update_task_status(
     task_id: int,
     # We will create this new Pydantic model next
-    update_data: schemas.TaskUpdate,
+    update_data: schemas.TaskUpdate = Depends(json_body(schemas.TASK_UPDATE_ADAPTER)),
     db: AsyncSession = Depends(get_db)
 ):
     task = await crud.get_task(db, task_id=task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     # We will create this new CRUD function next
-    return await crud.update_task(db, task=task, update_data=update_data)
\ No newline at end of file
+    task = await crud.update_task(db, task=task, update_data=update_data)
+    return json_response(schemas.TASK_READ_ADAPTER, task)
\ No newline at end of file
@@ -19,9 +19,9 @@ The JSON must have the following structure:
 }}
 """
 
-def get_step1_reasoning_prompt(prompt: str, timezone: str, tools: list[str]) -> str:
-    """Generates the reasoning prompt for the LLM (step 1)."""
-    return f"""
+# The prompts are mostly fixed text. Only the user-supplied segments are spliced in
+# per request; the constant parts are built once at import.
+_STEP1_PREFIX = """
 Analyze the user's request and extract the key information.
 
 1.  **Task Name:** A short name for the task.
@@ -33,19 +33,21 @@ Analyze the user's request and extract the key information.
 4.  **Schedule:** Describe the schedule.
 
 ---
-- **Available Tools:** {tools}
-- **User's Timezone:** {timezone}
-- **User's Request:** "{prompt}"
+- **Available Tools:** """
+_STEP1_TIMEZONE = """
+- **User's Timezone:** """
+_STEP1_REQUEST = """
+- **User's Request:** \""""
+_STEP1_SUFFIX = """\"
 ---
 **Analysis:**
 """
 
-def get_step2_formatting_prompt(analysis_text: str) -> str:
-    """
-    Step 2: Converts LLM analysis into a strictly validated JSON object
-    with structured schedule_details.value.
-    """
-    return f"""
+def get_step1_reasoning_prompt(prompt: str, timezone: str, tools: list[str]) -> str:
+    """Generates the reasoning prompt for the LLM (step 1)."""
+    return "".join([_STEP1_PREFIX, str(tools), _STEP1_TIMEZONE, timezone, _STEP1_REQUEST, prompt, _STEP1_SUFFIX])
+
+_STEP2_PREFIX = """
 Convert the following analysis into a valid JSON object following these rules:
 
 1. The JSON must include:
@@ -60,31 +62,31 @@ Convert the following analysis into a valid JSON object following these rules:
 
    - If "type" is "datetime":
      - "value" must be a dictionary:
-       {{
+       {
          "year": <YYYY>,
          "month": <MM>,
          "day": <DD>,
          "hour": <HH>,
          "minute": <MM>
-       }}
+       }
      - Do NOT output a plain string timestamp.
    
    - If "type" is "cron":
      - "value" must be a dictionary:
-       {{
+       {
          "minute": "*",
          "hour": "*",
          "day_of_week": "*",
          "day_of_month": "*",
          "month_of_year": "*"
-       }}
+       }
 
    - If "type" is "interval":
      - "value" must be a dictionary:
-       {{
+       {
          "every": <integer>,
          "period": "seconds" | "minutes" | "hours" | "days"
-       }}
+       }
 
 3. The `parameters` object MUST use the correct key names exactly as described in the analysis.
 4. The `tool_to_use` MUST match one of the available tools.
@@ -92,7 +94,15 @@ Convert the following analysis into a valid JSON object following these rules:
 
 ---
 Analysis to Convert:
-{analysis_text}
+"""
+_STEP2_SUFFIX = """
 ---
 JSON Output:
 """
+
+def get_step2_formatting_prompt(analysis_text: str) -> str:
+    """
+    Step 2: Converts LLM analysis into a strictly validated JSON object
+    with structured schedule_details.value.
+    """
+    return "".join([_STEP2_PREFIX, analysis_text, _STEP2_SUFFIX])
@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from croniter import croniter
+
+# NOTE: This module is shared with the Celery worker (it is mounted on its
+# Python path alongside sql_models), so it must not use relative imports.
+
+@lru_cache(maxsize=512)
+def _tz(name: str):
+    """Resolves a zone once per name; most tasks share a handful of zones."""
+    return ZoneInfo(name)
+
+def resolve_zone(name: str) -> tzinfo:
+    """Resolves a zone through the shared cache, falling back to UTC for an unknown name."""
+    try:
+        return _tz(name)
+    except (ValueError, ZoneInfoNotFoundError):
+        return timezone.utc
+
+@lru_cache(maxsize=4096)
+def _cron(expr: str, tz_name: str) -> croniter:
+    """
+    Parses a cron expression once per (expression, zone). The iterator is stateful, so
+    callers must re-seat it with set_current() and read the result before handing
+    control elsewhere.
+    """
+    return croniter(expr, datetime.now(_tz(tz_name)))
+
+def zone_clock(moment: datetime):
+    """
+    Returns a lookup of `moment` in a given zone that converts once per zone, e.g. for
+    the many tasks of one scheduler tick, which share a handful of zones.
+    """
+    local = {}
+    def in_zone(tz_name: str) -> datetime:
+        if tz_name not in local:
+            local[tz_name] = moment.astimezone(resolve_zone(tz_name)) if tz_name else moment
+        return local[tz_name]
+    return in_zone
+
+def warm_zones(tz_names) -> None:
+    """Resolves the given zones up front (e.g. every zone already stored at startup)."""
+    for name in filter(None, tz_names):
+        try:
+            _tz(name)
+        except (ValueError, ZoneInfoNotFoundError):
+            pass  # A bad zone surfaces when its task is scheduled, not at startup.
+
+# Interval periods are a closed set (see IntervalSchedule.period), so each maps to a fixed step.
+_PERIODS = {
+    "seconds": timedelta(seconds=1),
+    "minutes": timedelta(minutes=1),
+    "hours": timedelta(hours=1),
+    "days": timedelta(days=1),
+    "weeks": timedelta(weeks=1),
+}
+
+def compute_next_run_at(schedule_details: dict, tz_name: str, now: datetime, last_run_at: datetime | None = None) -> datetime | None:
+    """
+    Computes the next time a task with the given schedule becomes due, as an aware datetime.
+    Returns None when the schedule is incomplete and can therefore never fire.
+    """
+    match schedule_details:
+        case {"type": "cron", "value": str(cron_str)} if cron_str:
+            itr = _cron(cron_str, tz_name)
+            # Free when the caller already passes `now` in this zone (see zone_clock).
+            itr.set_current(now.astimezone(_tz(tz_name)), force=True)
+            return itr.get_next(datetime)
+
+        case {"type": "interval", "every": every, "period": period} if every and period in _PERIODS:
+            # A task that has never run is due straight away.
+            if not last_run_at:
+                return now
+            return last_run_at + every * _PERIODS[period]
+
+        case {"type": "datetime", "value": str(scheduled_time_str)} if scheduled_time_str:
+            scheduled_time_naive = datetime.fromisoformat(scheduled_time_str)
+            return scheduled_time_naive.replace(tzinfo=_tz(tz_name))
+
+    return None
+
+def topological_levels(depends_on: list[list[int] | None]) -> list[list[int]]:
+    """
+    Orders workflow steps into levels with Kahn's algorithm: every step in a level only
+    depends on steps in earlier levels, so the steps within one level can run concurrently.
+    `depends_on[i]` lists the indexes step i waits for; None means the previous step.
+    Raises ValueError for an unknown index or a dependency cycle.
+    """
+    n = len(depends_on)
+    in_degree = [0] * n
+    successors = [[] for _ in range(n)]
+    for i, deps in enumerate(depends_on):
+        if deps is None:
+            deps = [i - 1] if i else []
+        for dep in set(deps):
+            if not 0 <= dep < n or dep == i:
+                raise ValueError(f"Workflow step {i} depends on unknown step {dep}.")
+            successors[dep].append(i)
+            in_degree[i] += 1
+
+    levels = []
+    level = [i for i in range(n) if in_degree[i] == 0]
+    while level:
+        levels.append(level)
+        next_level = []
+        for i in level:
+            for succ in successors[i]:
+                in_degree[succ] -= 1
+                if in_degree[succ] == 0:
+                    next_level.append(succ)
+        level = next_level
+    if sum(map(len, levels)) != n:
+        raise ValueError("Workflow steps have a dependency cycle.")
+    return levels
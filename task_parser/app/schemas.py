@@ -1,7 +1,11 @@
-from pydantic import BaseModel, Field, ConfigDict
-from typing import Literal, Dict, List, Any, Union
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter, field_validator, model_validator
+from pydantic.dataclasses import dataclass
+from typing import Literal, Dict, List, Any, Union, Annotated
 from datetime import datetime
 from typing import Optional 
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from croniter import croniter
+from .scheduling import topological_levels
 # --- Input Model (from user) ---
 class TaskRequest(BaseModel):
     prompt: str
@@ -16,42 +20,102 @@ class TaskRequest(BaseModel):
 # It's good practice to define the parameters for each real tool.
 # This helps the LLM generate the correct arguments.
 
+# send_email takes **kwargs and reads `content`, `message` and `text` as aliases for `body`,
+# so its unknown keys are kept. scrape_web and call_api take fixed arguments, so unknown keys
+# are dropped rather than stored to fail every run. All leaf models are frozen: nothing
+# mutates them once validated.
+
 class SendEmailParams(BaseModel):
+    model_config = ConfigDict(extra="allow", frozen=True)
     recipient: str = Field(description="The email address of the recipient.")
     subject: str = Field(description="The subject line of the email.")
-    body: str = Field(description="The content of the email. Can include the placeholder '{PREVIOUS_STEP_RESULT}'.")
+    body: str = Field(default="", description="The content of the email. Can include the placeholder '{PREVIOUS_STEP_RESULT}'.")
 
 class ScrapeWebParams(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
     url: str = Field(description="The fully qualified URL to scrape (e.g., 'https://news.ycombinator.com').")
-    selector: str = Field(description="A mandatory CSS selector to extract specific elements. For example, to get all headlines, use 'h2'. For links in a title, use '.titleline > a'. The user must provide this or you must infer a sensible default.")
+    selector: str = Field(default="body", description="A mandatory CSS selector to extract specific elements. For example, to get all headlines, use 'h2'. For links in a title, use '.titleline > a'. The user must provide this or you must infer a sensible default.")
 
 class CallApiParams(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
     endpoint: str = Field(description="The API endpoint URL to call.")
     payload: Dict[str, Any] = Field(description="The JSON payload to send with the API request.")
 
+# Steps and schedules are plain data, and a poll can hold thousands of them, so they are
+# slotted, frozen pydantic dataclasses rather than models. The *Params models stay models
+# because slots leave nowhere to keep SendEmailParams' extra keys. kw_only lets a
+# defaulted field (a tag, or an inherited `depends_on`) come before required ones.
+_frozen_record = dataclass(frozen=True, slots=True, kw_only=True, config=ConfigDict(extra="ignore"))
+
 # --- Workflow Step Model ---
-class WorkflowStep(BaseModel):
+@_frozen_record
+class WorkflowStep:
     """A single step in a workflow to be executed."""
     tool_name: Literal["send_email", "scrape_web", "call_api"] = Field(description="The name of the tool to execute for this step.")
     parameters: Dict[str, Any] = Field(description="A dictionary of arguments for the chosen tool (e.g., {'recipient': '...', 'subject': '...'}).")
+    # The Gemini schema has no `default` keyword, so the default is kept out of the JSON schema.
+    depends_on: Optional[List[int]] = Field(default=None, json_schema_extra=lambda schema: schema.pop("default", None), description="Optional. The 0-based indexes of the earlier steps this step needs. Omit it to run after the previous step; steps whose dependencies are all done run in parallel.")
+
+# --- Typed Workflow Steps ---
+# One model per tool, tagged by `tool_name`, so validation goes straight to the right
+# parameter model instead of accepting any dictionary.
+
+@_frozen_record
+class _StepBase:
+    # Indexes of the steps this one waits for; None means "the previous step".
+    depends_on: Optional[List[int]] = None
+
+@_frozen_record
+class EmailStep(_StepBase):
+    tool_name: Literal["send_email"]
+    parameters: SendEmailParams
+
+@_frozen_record
+class ScrapeStep(_StepBase):
+    tool_name: Literal["scrape_web"]
+    parameters: ScrapeWebParams
+
+@_frozen_record
+class ApiStep(_StepBase):
+    tool_name: Literal["call_api"]
+    parameters: CallApiParams
+
+WorkflowStepSpec = Annotated[Union[EmailStep, ScrapeStep, ApiStep], Field(discriminator="tool_name")]
 
 # --- Schedule Models ---
 # These define the different ways a task can be scheduled.
 
-class CronSchedule(BaseModel):
+@_frozen_record
+class CronSchedule:
     type: Literal["cron"] = "cron"
     value: str = Field(description="A standard cron expression string, e.g., '0 9 * * 1' for every Monday at 9 AM.")
 
-class DateTimeSchedule(BaseModel):
+    @field_validator("value")
+    @classmethod
+    def _check_cron(cls, value: str) -> str:
+        if not croniter.is_valid(value):
+            raise ValueError(f"'{value}' is not a valid cron expression.")
+        return value
+
+@_frozen_record
+class DateTimeSchedule:
     type: Literal["datetime"] = "datetime"
     value: str = Field(description="A specific future date and time in ISO 8601 format, e.g., '2024-12-25T09:00:00'.")
 
-class IntervalSchedule(BaseModel):
+    @field_validator("value")
+    @classmethod
+    def _check_datetime(cls, value: str) -> str:
+        datetime.fromisoformat(value)  # Raises ValueError for anything that isn't ISO 8601.
+        return value
+
+@_frozen_record
+class IntervalSchedule:
     type: Literal["interval"] = "interval"
     every: int = Field(description="The number of periods to wait.")
-    period: Literal["seconds", "minutes", "hours", "days"] = Field(description="The unit of time for the interval.")
-
+    period: Literal["seconds", "minutes", "hours", "days", "weeks"] = Field(description="The unit of time for the interval.")
 
+# The `type` tag picks the schedule model directly instead of trying each one in turn.
+ScheduleValue = Annotated[Union[CronSchedule, DateTimeSchedule, IntervalSchedule], Field(discriminator="type")]
 
 
 class ScheduleTaskTool(BaseModel):
@@ -65,16 +129,43 @@ class ScheduleTaskTool(BaseModel):
     timezone: str = Field(description="The user's IANA timezone, e.g., 'Asia/Kolkata', 'America/New_York'.")
 
 
+# ScheduleTaskTool above doubles as the Gemini function declaration, which cannot express
+# tagged unions, so it stays loosely typed. This is what its arguments are validated into.
+class TaskCreate(BaseModel):
+    """A task to be created, with each workflow step and the schedule validated by their tag."""
+    # Bounded like the tasks.task_name / tasks.timezone columns.
+    task_name: str = Field(max_length=200)
+    workflow: list[WorkflowStepSpec]
+    schedule: ScheduleValue
+    timezone: str = Field(max_length=64)
+
+    @field_validator("timezone")
+    @classmethod
+    def _check_timezone(cls, value: str) -> str:
+        # The next run is computed in this zone when the task is stored, so it must exist.
+        try:
+            ZoneInfo(value)
+        except (ValueError, ZoneInfoNotFoundError):
+            raise ValueError(f"'{value}' is not an IANA timezone, e.g. 'Asia/Kolkata'.")
+        return value
+
+    @model_validator(mode="after")
+    def _check_dependencies(self):
+        # Rejects unknown step indexes and cycles before the task is stored.
+        topological_levels([step.depends_on for step in self.workflow])
+        return self
 
 # ==============================================================================
 # Pydantic Model for Reading a Task from the DB (for the /tasks endpoint)
 # We will need to update our DB schema to match the new structure later.
 # ==============================================================================
+# Rows stored before steps and schedules were validated by their tag may match none of the
+# tagged models; those fall back to the stored dict instead of failing the read.
 class Task(BaseModel):
     id: int
     task_name: str
-    workflow: List[Dict[str, Any]]  # The DB will store the workflow as a JSON object
-    schedule_details: Dict[str, Any] # The DB will store the schedule as a JSON object
+    workflow: List[Annotated[Union[WorkflowStepSpec, Dict[str, Any]], Field(union_mode="left_to_right")]]  # The DB will store the workflow as a JSON object
+    schedule_details: Annotated[Union[ScheduleValue, Dict[str, Any]], Field(union_mode="left_to_right")]  # The DB will store the schedule as a JSON object
     timezone: str
     is_active: bool
     created_at: datetime
@@ -85,4 +176,13 @@ class Task(BaseModel):
 
 # --- NEW: Pydantic model for updating a task ---
 class TaskUpdate(BaseModel):
-    is_active: Optional[bool] = None
\ No newline at end of file
+    is_active: Optional[bool] = None
+
+
+# --- Shared Validators ---
+# Built once at import so request handlers never pay for building a validator.
+TASK_CREATE_ADAPTER = TypeAdapter(TaskCreate)
+TASK_READ_ADAPTER = TypeAdapter(Task)
+TASK_LIST_ADAPTER = TypeAdapter(list[Task])
+TASK_REQUEST_ADAPTER = TypeAdapter(TaskRequest)
+TASK_UPDATE_ADAPTER = TypeAdapter(TaskUpdate)
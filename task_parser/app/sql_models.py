@@ -1,19 +1,82 @@
+from datetime import datetime
 from sqlalchemy import (
-    Column, Integer, String, Boolean, DateTime, JSON, func
+    Integer, String, Boolean, DateTime, JSON, Index, FetchedValue, func, text
 )
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
-Base = declarative_base()
+# Binary JSONB on PostgreSQL, so reads skip re-parsing the text; plain JSON elsewhere.
+JSONType = JSON().with_variant(JSONB(), "postgresql")
+
+class Base(DeclarativeBase):
+    pass
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # Lets the scheduler seek straight to the active tasks that are due.
+        Index("ix_task_due", "next_run_at", postgresql_where=text("is_active")),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    task_name: Mapped[str | None] = mapped_column(String(200))
+    workflow: Mapped[list[dict]] = mapped_column(JSONType, server_default=text("'[]'"))  # Stores the list of steps for the task
+    schedule_details: Mapped[dict | None] = mapped_column(JSONType)
+    timezone: Mapped[str | None] = mapped_column(String(64))  # IANA names are at most ~32 characters
+    is_active: Mapped[bool | None] = mapped_column(Boolean, default=True)
+    last_run_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+    next_run_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # When the scheduler should next dispatch it
+    created_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    # Set by the tasks_set_updated_at trigger below, so UPDATEs never have to carry it.
+    updated_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), server_onupdate=FetchedValue())
+
+# Installed on every API start, so a table created by another version (or by someone else)
+# still gets it. Kept as two statements because asyncpg prepares each one and rejects
+# multi-statement strings. CREATE OR REPLACE TRIGGER needs PostgreSQL 14+.
+UPDATED_AT_TRIGGER = (
+    "CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$ "
+    "BEGIN NEW.updated_at := now(); RETURN NEW; END; $$ LANGUAGE plpgsql",
+    "CREATE OR REPLACE TRIGGER tasks_set_updated_at BEFORE UPDATE ON tasks "
+    "FOR EACH ROW EXECUTE FUNCTION set_updated_at()",
+)
+
+def _column_is(column: str, condition: str) -> str:
+    return (
+        "SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() "
+        f"AND table_name = 'tasks' AND column_name = '{column}' AND {condition})"
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
-    task_name = Column(String, index=True)
-    workflow = Column(JSON)  # Stores the list of steps for the task
-    schedule_details = Column(JSON)
-    timezone = Column(String)
-    is_active = Column(Boolean, default=True)
-    last_run_at = Column(DateTime(timezone=True), nullable=True)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
\ No newline at end of file
+def _column_missing(column: str) -> str:
+    return (
+        "SELECT NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() "
+        f"AND table_name = 'tasks' AND column_name = '{column}')"
+    )
+
+def _index_exists(name: str) -> str:
+    return f"SELECT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() AND indexname = '{name}')"
+
+def _index_missing(name: str) -> str:
+    return f"SELECT NOT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() AND indexname = '{name}')"
+
+# create_all() leaves an existing tasks table untouched, so these bring a table created by
+# an earlier version up to date (PostgreSQL only). Each entry is (check, *statements): the
+# statements run only while the catalog query `check` returns true, so a table that is
+# already up to date is neither locked nor scanned. Nothing is truncated: a column holding
+# values longer than its new bound fails that step, which is logged and left as it is.
+SCHEMA_UPGRADES = (
+    (_column_missing("next_run_at"), "ALTER TABLE tasks ADD COLUMN next_run_at TIMESTAMP WITH TIME ZONE"),
+    (_index_missing("ix_task_due"), "CREATE INDEX ix_task_due ON tasks (next_run_at) WHERE is_active"),
+    # Nothing looks tasks up by name, and the primary key already indexes id.
+    (_index_exists("ix_tasks_id"), "DROP INDEX ix_tasks_id"),
+    (_index_exists("ix_tasks_task_name"), "DROP INDEX ix_tasks_task_name"),
+    (_column_is("workflow", "data_type = 'json'"), "ALTER TABLE tasks ALTER COLUMN workflow TYPE jsonb USING workflow::jsonb"),
+    (_column_is("schedule_details", "data_type = 'json'"), "ALTER TABLE tasks ALTER COLUMN schedule_details TYPE jsonb USING schedule_details::jsonb"),
+    (_column_is("workflow", "column_default IS NULL"), "ALTER TABLE tasks ALTER COLUMN workflow SET DEFAULT '[]'"),
+    (
+        _column_is("workflow", "is_nullable = 'YES'"),
+        "UPDATE tasks SET workflow = '[]' WHERE workflow IS NULL",
+        "ALTER TABLE tasks ALTER COLUMN workflow SET NOT NULL",
+    ),
+    (_column_is("task_name", "character_maximum_length IS DISTINCT FROM 200"), "ALTER TABLE tasks ALTER COLUMN task_name TYPE VARCHAR(200)"),
+    (_column_is("timezone", "character_maximum_length IS DISTINCT FROM 64"), "ALTER TABLE tasks ALTER COLUMN timezone TYPE VARCHAR(64)"),
+)